@@ -7,12 +7,25 @@ st.set_page_config(
 )
 
 import pandas as pd
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from bisect import bisect_left, bisect_right
+import math
 import os
 import time
+import threading
+import gzip
+import hashlib
+import shutil
+import tempfile
+import pyarrow as pa
 from supabase import create_client, Client
 import json
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Thumbnail tidak dibuat jika Pillow tidak tersedia
+    Image = None
+
 
 # Custom CSS untuk tampilan e-commerce
 st.markdown("""
@@ -75,6 +88,50 @@ def init_supabase_connection():
         st.sidebar.error(f"❌ Koneksi Supabase gagal: {e}")
         return None
 
+# ==================== KONFIGURASI CABANG ====================
+# Setiap cabang punya partisi data, urutan No Nota Retur, dan cache sendiri.
+# Cabang didefinisikan di secrets.toml, contoh:
+#   [BRANCHES.pdhero]
+#   nama = "PD Hero"
+#   tujuan = "PT CAPP"
+#   approver = "Pak Taufik"
+# Data lama (sebelum multi-cabang) masuk ke LEGACY_BRANCH lewat default kolom branch di
+# schema.sql, jadi cabang ini selalu tersedia walaupun tidak ada di secrets.
+LEGACY_BRANCH = "pdhero"
+DEFAULT_BRANCHES = {
+    LEGACY_BRANCH: {"nama": "PD Hero", "tujuan": "PT CAPP", "approver": "Pak Taufik"}
+}
+
+def load_branches():
+    """Baca daftar cabang dari secrets; cabang legacy selalu disertakan"""
+    try:
+        branches = {code: dict(config) for code, config in st.secrets.get("BRANCHES", {}).items()}
+    except Exception:
+        branches = {}
+    if LEGACY_BRANCH not in branches:
+        branches = {**DEFAULT_BRANCHES, **branches}
+    return branches
+
+BRANCHES = load_branches()
+
+def branch_config():
+    """Konfigurasi cabang yang dipilih di sesi ini"""
+    return BRANCHES[st.session_state.branch]
+
+# Status akhir disimpan dengan nilai tetap; nama approver cabang hanya dipakai di label
+STATUS_SENT = "Sudah Dikirim"
+
+def sent_label():
+    """Label status akhir untuk cabang aktif"""
+    return f"Sudah Kirim ke {branch_config()['approver']}"
+
+def reset_branch_session():
+    """Kosongkan state sesi yang terikat ke cabang sebelumnya"""
+    st.session_state.retur_data = None
+    st.session_state.show_destroy_form = None
+    st.session_state.show_add_form = False
+    st.session_state.expanded_cards = {}
+
 # ==================== INISIALISASI SESSION STATE ====================
 if 'initialized' not in st.session_state:
     st.session_state.initialized = True
@@ -83,20 +140,166 @@ if 'initialized' not in st.session_state:
     st.session_state.show_add_form = False
     st.session_state.supabase = init_supabase_connection()
 
+# Cabang aktif sesi ini
+if st.session_state.get('branch') not in BRANCHES:
+    st.session_state.branch = next(iter(BRANCHES))
+
 # Inisialisasi expanded_cards jika belum ada
 if 'expanded_cards' not in st.session_state:
     st.session_state.expanded_cards = {}
 
+# Lampiran yang sudah diminta untuk dimuat penuh (hanya key, bukan isi file)
+if 'opened_attachments' not in st.session_state:
+    st.session_state.opened_attachments = set()
+
+# ==================== SNAPSHOT CACHE TABEL ====================
+# Salinan tabel retur dibagi semua sesi dan disimpan sebagai file Arrow beserta
+# high-water mark row_version dan id tombstone terakhir. row_version diisi trigger
+# database di setiap insert/update (bukan jam klien), sehingga setelah restart snapshot
+# di-memory-map lalu hanya baris yang berubah/dihapus sejak itu yang diambil dari Supabase.
+SNAPSHOT_DIR = ".cache"
+SNAPSHOT_VERSION = b"4"
+SUPABASE_PAGE_SIZE = 1000
+
+def snapshot_path(branch):
+    """Lokasi file snapshot untuk satu cabang"""
+    return os.path.join(SNAPSHOT_DIR, f"retur_snapshot_{branch}.arrow")
+
+def read_table_snapshot(path):
+    """Baca snapshot Arrow, return (DataFrame, high-water mark, id tombstone) atau (None, None, 0) jika tidak valid"""
+    try:
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        metadata = table.schema.metadata or {}
+        if metadata.get(b"version") != SNAPSHOT_VERSION:
+            return None, None, 0
+        df = table.to_pandas()
+        hwm = metadata.get(b"hwm", b"")
+        if 'id' not in df.columns or 'row_version' not in df.columns or not hwm:
+            return None, None, 0
+        return df, int(hwm), int(metadata.get(b"tomb_id", b"0"))
+    except Exception:
+        return None, None, 0
+
+def write_table_snapshot(df, hwm, tomb_id, path):
+    """Tulis snapshot Arrow secara atomik (file sementara lalu rename)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        b"version": SNAPSHOT_VERSION,
+        b"hwm": ("" if hwm is None else str(hwm)).encode(),
+        b"tomb_id": str(tomb_id).encode()
+    })
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def drop_table_snapshot(path):
+    """Hapus snapshot sehingga load berikutnya mengambil seluruh tabel"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _save_snapshot(cache):
+    try:
+        write_table_snapshot(cache['df'], cache['hwm'], cache['tomb_id'], cache['path'])
+    except Exception:
+        drop_table_snapshot(cache['path'])
+
+def _high_water_mark(df):
+    if df.empty:
+        return 0
+    if 'row_version' not in df.columns:
+        return None
+    values = df['row_version'].dropna()
+    return int(values.max()) if not values.empty else 0
+
+def fetch_pages(build_query, after_id=0, page_size=SUPABASE_PAGE_SIZE):
+    """Ambil semua baris per halaman berdasarkan id (Supabase membatasi jumlah baris per response)"""
+    rows = []
+    while True:
+        page = build_query().gt("id", after_id).order("id").limit(page_size).execute().data or []
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+        after_id = page[-1]['id']
+
+def sync_table_cache(cache):
+    """Bawa cache up-to-date: delta fetch sejak high-water mark, full fetch jika tidak ada/tidak cocok"""
+    supabase, branch = cache['supabase'], cache['branch']
+    with cache['lock']:
+        df, hwm, tomb_id = cache['df'], cache['hwm'], cache['tomb_id']
+        
+        if df is not None and hwm is not None:
+            delta = fetch_pages(lambda: supabase.table("retur").select("*").eq("branch", branch).gt("row_version", hwm))
+            if delta:
+                df = pd.concat([df, pd.DataFrame(delta)], ignore_index=True)
+                df = df.drop_duplicates(subset='id', keep='last').reset_index(drop=True)
+            
+            # Baris yang dihapus dicatat trigger di retur_deleted (tombstone)
+            tombstones = fetch_pages(
+                lambda: supabase.table("retur_deleted").select("id,retur_id").eq("branch", branch),
+                after_id=tomb_id
+            )
+            if tombstones:
+                deleted_ids = {t['retur_id'] for t in tombstones}
+                df = df[~df['id'].isin(deleted_ids)].reset_index(drop=True)
+                tomb_id = tombstones[-1]['id']
+            
+            # Pengaman terakhir: jumlah baris harus sama (count dari header, tanpa mengunduh id)
+            total = supabase.table("retur").select("id", count="exact").eq("branch", branch).limit(1).execute().count
+            if total != len(df):
+                df = None
+        
+        if df is None:
+            # Ambil id tombstone terakhir lebih dulu: penghapusan selama full fetch ikut diproses di delta berikutnya
+            latest = supabase.table("retur_deleted").select("id").eq("branch", branch).order("id", desc=True).limit(1).execute()
+            tomb_id = latest.data[0]['id'] if latest.data else 0
+            df = pd.DataFrame(fetch_pages(lambda: supabase.table("retur").select("*").eq("branch", branch)))
+        
+        new_hwm = _high_water_mark(df)
+        changed = (new_hwm != cache['hwm'] or tomb_id != cache['tomb_id']
+                   or cache['df'] is None or len(df) != len(cache['df']))
+        cache['df'], cache['hwm'], cache['tomb_id'] = df, new_hwm, tomb_id
+        if changed:
+            _save_snapshot(cache)
+        return df.copy()
+
+def remove_from_table_cache(cache, no_nota_retur):
+    """Buang baris yang dihapus dari cache bersama"""
+    with cache['lock']:
+        if cache['df'] is not None and 'no_nota_retur' in cache['df'].columns:
+            cache['df'] = cache['df'][cache['df']['no_nota_retur'] != no_nota_retur].reset_index(drop=True)
+            _save_snapshot(cache)
+
+def reset_table_cache(cache):
+    """Buang cache dan snapshot satu cabang sehingga load berikutnya full fetch"""
+    with cache['lock']:
+        cache['df'], cache['hwm'], cache['tomb_id'] = None, None, 0
+        drop_table_snapshot(cache['path'])
+
+@st.cache_resource
+def get_table_cache(_supabase, branch):
+    """Cache tabel retur per cabang yang dibagi semua sesi, diawali dari snapshot di disk"""
+    path = snapshot_path(branch)
+    df, hwm, tomb_id = read_table_snapshot(path)
+    return {'supabase': _supabase, 'branch': branch, 'path': path,
+            'lock': threading.Lock(), 'df': df, 'hwm': hwm, 'tomb_id': tomb_id}
+
 # ==================== FUNGSI DATABASE SUPABASE ====================
 def load_data():
-    """Load data dari Supabase"""
+    """Load data cabang aktif dari Supabase"""
     try:
         supabase = st.session_state.supabase
         if supabase:
-            response = supabase.table("retur").select("*").order("created_at", desc=True).execute()
+            df = sync_table_cache(get_table_cache(supabase, st.session_state.branch))
             
-            if response.data:
-                df = pd.DataFrame(response.data)
+            if not df.empty:
+                if 'created_at' in df.columns:
+                    df = df.sort_values('created_at', ascending=False, na_position='last').reset_index(drop=True)
                 
                 # DEBUG: Tampilkan kolom yang ada
                 st.sidebar.write("📊 Kolom dari database:", list(df.columns))
@@ -113,6 +316,7 @@ def load_data():
                     'alasan': 'Alasan',
                     'form_retur': 'Form Retur',
                     'berita_acara': 'Berita Acara',
+                    'branch': 'Cabang',
                     'status': 'Status',  # Pastikan ini 'status' bukan 'Status'
                     'created_at': 'Dibuat Pada',
                     'updated_at': 'Diupdate Pada'
@@ -136,43 +340,58 @@ def load_data():
         st.error(f"Error loading data: {e}")
         return pd.DataFrame()
 
-def save_data_automatic(df):
-    """Simpan data ke Supabase"""
+def to_supabase_record(record, branch):
+    """Ubah satu baris DataFrame menjadi record tabel retur"""
+    return {
+        'no_nota_retur': record['No Nota Retur'],
+        'tanggal_pengajuan': record['Tanggal Pengajuan'],
+        'nama_barang': record['Nama Barang'],
+        'quantity': record['Quantity'],
+        'satuan': record['Satuan'],
+        'tanggal_ed': record['Tanggal ED'],
+        'alasan': record['Alasan'],
+        'form_retur': record.get('Form Retur', ''),
+        'berita_acara': record.get('Berita Acara', ''),
+        'status': record['Status'],
+        'branch': branch,
+        'created_at': record['Dibuat Pada'],
+        'updated_at': record['Diupdate Pada']
+    }
+
+def insert_retur(df):
+    """Insert retur baru saja; nomor nota yang bentrok gagal (unique index), tidak menimpa retur lain"""
     try:
         supabase = st.session_state.supabase
         if supabase:
-            # Convert dataframe to records
-            records = df.to_dict('records')
-            
+            records = [to_supabase_record(record, st.session_state.branch) for record in df.to_dict('records')]
+            supabase.table("retur").insert(records).execute()
             for record in records:
-                # Prepare data for Supabase
-                supabase_data = {
-                    'no_nota_retur': record['No Nota Retur'],
-                    'tanggal_pengajuan': record['Tanggal Pengajuan'],
-                    'nama_barang': record['Nama Barang'],
-                    'quantity': record['Quantity'],
-                    'satuan': record['Satuan'],
-                    'tanggal_ed': record['Tanggal ED'],
-                    'alasan': record['Alasan'],
-                    'form_retur': record.get('Form Retur', ''),
-                    'berita_acara': record.get('Berita Acara', ''),
-                    'status': record['Status'],
-                    'created_at': record['Dibuat Pada'],
-                    'updated_at': record['Diupdate Pada']
-                }
-                
-                # Check if record exists
-                existing = supabase.table("retur").select("*").eq("no_nota_retur", supabase_data["no_nota_retur"]).execute()
-                
-                if existing.data:
-                    # Update existing record
-                    result = supabase.table("retur").update(supabase_data).eq("no_nota_retur", supabase_data["no_nota_retur"]).execute()
-                    st.sidebar.success(f"✅ Updated: {supabase_data['no_nota_retur']}")
-                else:
-                    # Insert new record
-                    result = supabase.table("retur").insert(supabase_data).execute()
-                    st.sidebar.success(f"✅ Inserted: {supabase_data['no_nota_retur']}")
-            
+                st.sidebar.success(f"✅ Inserted: {record['no_nota_retur']}")
+            return True
+    except Exception as e:
+        st.error(f"Error saving data: {e}")
+        return False
+
+def update_retur(no_nota_retur, changes, expected_status):
+    """Update kolom tertentu satu retur saja, hanya jika statusnya masih expected_status
+
+    Baris lain di DataFrame sesi (yang bisa sudah basi) tidak ditulis ulang.
+    """
+    try:
+        supabase = st.session_state.supabase
+        if supabase:
+            result = (
+                supabase.table("retur").update(changes)
+                .eq("branch", st.session_state.branch)
+                .eq("no_nota_retur", no_nota_retur)
+                .eq("status", expected_status)
+                .execute()
+            )
+            if not result.data:
+                st.error(f"Retur {no_nota_retur} sudah diubah di sesi lain, data dimuat ulang.")
+                st.session_state.retur_data = load_data()
+                return False
+            st.sidebar.success(f"✅ Updated: {no_nota_retur}")
             return True
     except Exception as e:
         st.error(f"Error saving data: {e}")
@@ -183,13 +402,90 @@ def delete_retur(no_nota_retur):
     try:
         supabase = st.session_state.supabase
         if supabase:
-            result = supabase.table("retur").delete().eq("no_nota_retur", no_nota_retur).execute()
+            branch = st.session_state.branch
+            result = supabase.table("retur").delete().eq("branch", branch).eq("no_nota_retur", no_nota_retur).execute()
+            remove_from_table_cache(get_table_cache(supabase, branch), no_nota_retur)
             st.sidebar.success(f"✅ Deleted: {no_nota_retur}")
             return True
     except Exception as e:
         st.error(f"Error deleting data: {e}")
         return False
 
+# ==================== LOG EVENT STATUS ====================
+# Setiap perpindahan status ditambahkan ke tabel retur_events (append-only).
+# Trigger di database memperbarui agregat retur_lead_time_stats per event baru
+# (jumlah, total hari, histogram bucket), sehingga tidak ada perhitungan ulang.
+# Batas atas bucket histogram (hari); harus sama dengan lead_time_bucket() di schema.sql
+LEAD_TIME_BUCKETS = [0.5, 1, 2, 3, 5, 7, 10, 14, 21, 30, 45, 60, 90, 180]
+
+def log_status_event(no_nota_retur, nama_barang, from_status, to_status, event_at):
+    """Catat perpindahan status ke tabel retur_events"""
+    try:
+        supabase = st.session_state.supabase
+        if supabase:
+            supabase.table("retur_events").insert({
+                'branch': st.session_state.branch,
+                'no_nota_retur': no_nota_retur,
+                'nama_barang': nama_barang,
+                'from_status': from_status,
+                'to_status': to_status,
+                'event_at': event_at
+            }).execute()
+            return True
+    except Exception as e:
+        st.sidebar.warning(f"⚠️ Event status tidak tercatat: {e}")
+        return False
+
+def bucket_percentile(buckets, count, q):
+    """Perkirakan persentil dari histogram bucket, return label batas atas bucket"""
+    target = max(math.ceil(q * count), 1)
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= target:
+            if i < len(LEAD_TIME_BUCKETS):
+                return f"≤ {LEAD_TIME_BUCKETS[i]:g}"
+            return f"> {LEAD_TIME_BUCKETS[-1]:g}"
+    return "-"
+
+def lead_time_table(rows, dimension, group_label):
+    """Ubah baris agregat satu dimensi menjadi DataFrame rata-rata dan p90 (hari)"""
+    table = []
+    for row in sorted(rows, key=lambda r: (r['stage'], r['group_key'])):
+        if row['dimension'] != dimension or not row['event_count']:
+            continue
+        table.append({
+            'Status': row['stage'],
+            group_label: row['group_key'],
+            'Jumlah': row['event_count'],
+            'Rata-rata (hari)': round(row['total_days'] / row['event_count'], 1),
+            'P90 (hari)': bucket_percentile(row['buckets'], row['event_count'], 0.9)
+        })
+    return pd.DataFrame(table)
+
+def display_lead_time_stats(supabase, branch):
+    """Tampilkan lama waktu di setiap status per minggu dan per barang"""
+    st.subheader("⏱️ Lama Waktu per Status")
+    
+    try:
+        rows = fetch_pages(lambda: supabase.table("retur_lead_time_stats").select("*").eq("branch", branch))
+    except Exception as e:
+        st.warning(f"Agregat lama waktu tidak dapat dimuat: {e}")
+        return
+    
+    by_week = lead_time_table(rows, 'week', 'Minggu')
+    by_product = lead_time_table(rows, 'product', 'Nama Barang')
+    
+    if by_week.empty:
+        st.info("Belum ada perpindahan status yang tercatat")
+        return
+    
+    tab_week, tab_product = st.tabs(["Per Minggu", "Per Barang"])
+    with tab_week:
+        st.dataframe(by_week, hide_index=True, use_container_width=True)
+    with tab_product:
+        st.dataframe(by_product, hide_index=True, use_container_width=True)
+
 # ==================== FUNGSI UTILITAS ====================
 def format_tanggal(tanggal):
     """Format tanggal untuk display"""
@@ -213,29 +509,319 @@ def format_tanggal(tanggal):
     return "Tanggal tidak tersedia"
 
 def generate_nota_number():
-    """Generate nomor nota otomatis"""
+    """Ambil nomor nota berikutnya dari sequence per cabang di database (next_nota_number)"""
+    year_month = date.today().strftime("%Y/%m")
+    response = st.session_state.supabase.rpc("next_nota_number", {
+        'p_branch': st.session_state.branch,
+        'p_year_month': year_month
+    }).execute()
+    return f"{year_month}/{response.data[0]['nota_number']:03d}"
+
+# ==================== WATCHLIST TANGGAL ED ====================
+# Horizon maksimum watchlist (hari) dan status yang barangnya masih ada di gudang
+EXPIRY_HORIZON_DAYS = 90
+EXPIRY_ACTIVE_STATUSES = ["Menunggu Persetujuan", "Sudah Disetujui"]
+
+def fetch_expiry_candidates(supabase, branch, horizon_days=EXPIRY_HORIZON_DAYS):
+    """Ambil semua retur aktif cabang dengan ED <= hari ini + horizon (memakai idx_retur_branch_tanggal_ed)
+
+    Diambil per halaman berdasarkan id agar tidak terpotong batas 1000 baris Supabase;
+    pengurutan berdasarkan ED dilakukan di build_expiry_index.
+    """
+    batas = (date.today() + timedelta(days=horizon_days)).strftime('%Y-%m-%d')
+    return fetch_pages(
+        lambda: supabase.table("retur")
+        .select("id,no_nota_retur,nama_barang,quantity,satuan,tanggal_ed,status")
+        .eq("branch", branch)
+        .in_("status", EXPIRY_ACTIVE_STATUSES)
+        .lte("tanggal_ed", batas)
+    )
+
+def build_expiry_index(records):
+    """Bangun indeks terurut: list ordinal tanggal ED dan list record yang sejajar"""
+    keyed = []
+    for record in records:
+        try:
+            ed = datetime.strptime(str(record['tanggal_ed'])[:10], '%Y-%m-%d').date()
+        except (KeyError, ValueError, TypeError):
+            continue
+        keyed.append((ed.toordinal(), record))
+    keyed.sort(key=lambda item: item[0])
+    return [key for key, _ in keyed], [record for _, record in keyed]
+
+def query_expiry_range(index, start, end):
+    """Ambil record dengan start <= ED <= end dalam O(log n + k) memakai bisect"""
+    keys, records = index
+    lo = bisect_left(keys, start.toordinal())
+    hi = bisect_right(keys, end.toordinal())
+    return records[lo:hi]
+
+def count_expired(index, today):
+    """Jumlah retur aktif yang ED-nya sudah lewat"""
+    keys, _ = index
+    return bisect_left(keys, today.toordinal())
+
+def refresh_expiry_watchlist(watchlist):
+    """Hitung ulang watchlist ED dan simpan ke cache bersama"""
+    try:
+        index = build_expiry_index(fetch_expiry_candidates(watchlist['supabase'], watchlist['branch']))
+    except Exception as e:
+        watchlist['error'] = str(e)
+        return False
+    with watchlist['lock']:
+        watchlist['index'] = index
+        watchlist['computed_for'] = date.today()
+        watchlist['computed_at'] = datetime.now()
+        watchlist['error'] = None
+    return True
+
+def _expiry_scheduler(watchlist, stop_event):
+    """Job latar belakang: perbarui watchlist setiap pergantian hari sampai dihentikan"""
+    while not stop_event.is_set():
+        if watchlist['computed_for'] != date.today():
+            refresh_expiry_watchlist(watchlist)
+        now = datetime.now()
+        besok = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        stop_event.wait(min(max((besok - now).total_seconds(), 1), 3600))
+
+def start_expiry_scheduler(watchlist):
+    """Jalankan satu scheduler per cabang di proses ini; scheduler lama (mis. setelah cache di-clear) dihentikan"""
+    name = f"expiry-scheduler-{watchlist['branch']}"
+    for thread in threading.enumerate():
+        if thread.name == name and hasattr(thread, 'stop_event'):
+            thread.stop_event.set()
+    stop_event = threading.Event()
+    thread = threading.Thread(target=_expiry_scheduler, args=(watchlist, stop_event), name=name, daemon=True)
+    thread.stop_event = stop_event
+    thread.start()
+
+@st.cache_resource
+def get_expiry_watchlist(_supabase, branch):
+    """Watchlist ED per cabang yang dibagi semua sesi, diperbarui oleh job harian"""
+    watchlist = {
+        'supabase': _supabase,
+        'branch': branch,
+        'lock': threading.Lock(),
+        'index': ([], []),
+        'computed_for': None,
+        'computed_at': None,
+        'error': None,
+    }
+    refresh_expiry_watchlist(watchlist)
+    start_expiry_scheduler(watchlist)
+    return watchlist
+
+def display_expiry_watchlist(watchlist):
+    """Tampilkan daftar retur yang akan segera kedaluwarsa"""
+    st.markdown("### ⏰ Watchlist Tanggal ED")
+    
+    if watchlist.get('error'):
+        st.warning(f"Watchlist ED gagal diperbarui: {watchlist['error']}")
+    
+    with watchlist['lock']:
+        index = watchlist['index']
+        computed_at = watchlist['computed_at']
+    
     today = date.today()
-    year_month = today.strftime("%Y/%m")
+    hari = st.slider("Kedaluwarsa dalam (hari)", min_value=1, max_value=EXPIRY_HORIZON_DAYS,
+                     value=30, key="expiry_days")
+    expiring = query_expiry_range(index, today, today + timedelta(days=hari))
+    expired = count_expired(index, today)
     
-    last_number = 0
-    if st.session_state.retur_data is not None and not st.session_state.retur_data.empty:
-        current_month_data = st.session_state.retur_data[
-            st.session_state.retur_data["No Nota Retur"].str.startswith(year_month, na=False)
-        ]
-        
-        if not current_month_data.empty:
-            for nota in current_month_data["No Nota Retur"]:
-                try:
-                    parts = nota.split('/')
-                    if len(parts) == 3:
-                        number = int(parts[2])
-                        if number > last_number:
-                            last_number = number
-                except:
-                    continue
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric(f"ED dalam {hari} hari", len(expiring))
+    with col2:
+        st.metric("Sudah lewat ED", expired)
+    
+    if expiring:
+        st.dataframe(
+            pd.DataFrame(expiring).drop(columns='id', errors='ignore').rename(columns={
+                'no_nota_retur': 'No Nota Retur',
+                'nama_barang': 'Nama Barang',
+                'quantity': 'Quantity',
+                'satuan': 'Satuan',
+                'tanggal_ed': 'Tanggal ED',
+                'status': 'Status'
+            }),
+            hide_index=True,
+            use_container_width=True
+        )
+    else:
+        st.info(f"Tidak ada retur aktif yang kedaluwarsa dalam {hari} hari")
+    
+    if computed_at is not None:
+        st.caption(f"Diperbarui: {computed_at.strftime('%d %b %Y %H:%M')}")
+
+# ==================== PENYIMPANAN LAMPIRAN ====================
+# Form Retur dan Berita Acara disimpan di blob store dengan key = hash SHA-256 isi file,
+# sehingga scan yang identik hanya tersimpan sekali. Kolom di tabel retur hanya menyimpan key.
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_THUMB_SIZE = (320, 320)
+ATTACHMENT_TYPES = ["pdf", "jpg", "jpeg", "png"]
+ATTACHMENT_IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+ATTACHMENT_URL_EXPIRES = 3600
+
+class LocalBlobStore:
+    """Blob store di filesystem lokal"""
+    
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, "thumbs"), exist_ok=True)
+    
+    def _path(self, key):
+        return os.path.join(self.root, key)
+    
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+    
+    def put(self, key, src_path, content_type):
+        tmp_path = self._path(key) + ".tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, self._path(key))
+    
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+    
+    def open(self, key):
+        if key.endswith('.gz'):
+            return gzip.open(self._path(key), 'rb')
+        return open(self._path(key), 'rb')
+    
+    def signed_url(self, key):
+        return None
+
+class SupabaseBlobStore:
+    """Blob store di bucket Supabase Storage"""
+    
+    def __init__(self, supabase, bucket):
+        self.bucket = supabase.storage.from_(bucket)
+    
+    def exists(self, key):
+        folder, _, name = key.rpartition('/')
+        files = self.bucket.list(folder, {"search": name})
+        return any(f.get('name') == name for f in files or [])
+    
+    def put(self, key, src_path, content_type):
+        # Upsert: key = hash konten, menimpa objek dengan key sama selalu aman
+        self.bucket.upload(key, src_path, {"content-type": content_type, "x-upsert": "true"})
+    
+    def get(self, key):
+        return self.bucket.download(key)
+    
+    def open(self, key):
+        return None
+    
+    def signed_url(self, key):
+        response = self.bucket.create_signed_url(key, ATTACHMENT_URL_EXPIRES)
+        return response.get('signedURL') or response.get('signedUrl')
+
+@st.cache_resource
+def _supabase_blob_store(_supabase, bucket):
+    return SupabaseBlobStore(_supabase, bucket)
+
+@st.cache_resource
+def _local_blob_store(root):
+    return LocalBlobStore(root)
+
+def get_blob_store(supabase):
+    """Pilih blob store sesuai secrets ATTACHMENT_STORE (supabase/local)"""
+    store_type = st.secrets.get("ATTACHMENT_STORE", "supabase")
+    if store_type == "supabase" and supabase is not None:
+        return _supabase_blob_store(supabase, st.secrets.get("ATTACHMENT_BUCKET", "retur-lampiran"))
+    return _local_blob_store(st.secrets.get("ATTACHMENT_DIR", "lampiran"))
+
+def thumbnail_key(key):
+    """Key thumbnail untuk lampiran gambar"""
+    return f"thumbs/{key.split('.')[0]}.jpg"
+
+def is_image_key(key):
+    """Lampiran gambar punya thumbnail"""
+    return os.path.splitext(key)[1].lower() in ATTACHMENT_IMAGE_EXTS
+
+def ingest_attachment(store, uploaded_file):
+    """Simpan file upload ke blob store secara streaming, return key hash konten
+
+    File asli disimpan utuh (scan adalah dokumen resmi); untuk gambar dibuat
+    thumbnail JPEG kecil sebagai preview.
+    """
+    hasher = hashlib.sha256()
+    uploaded_file.seek(0)
+    for chunk in iter(lambda: uploaded_file.read(ATTACHMENT_CHUNK_SIZE), b''):
+        hasher.update(chunk)
+    digest = hasher.hexdigest()
+    key = f"{digest}{os.path.splitext(uploaded_file.name)[1].lower()}"
     
-    new_number = last_number + 1
-    return f"{year_month}/{new_number:03d}"
+    # Scan identik sudah tersimpan -> cukup pakai key yang sama (thumbnail dilengkapi jika belum ada)
+    need_blob = not store.exists(key)
+    need_thumb = Image is not None and is_image_key(key) and not store.exists(thumbnail_key(key))
+    if not need_blob and not need_thumb:
+        return key
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if need_blob:
+            blob_path = os.path.join(tmp_dir, "blob")
+            uploaded_file.seek(0)
+            with open(blob_path, 'wb') as out:
+                shutil.copyfileobj(uploaded_file, out, ATTACHMENT_CHUNK_SIZE)
+            store.put(key, blob_path, uploaded_file.type or 'application/octet-stream')
+        if need_thumb:
+            thumb_path = os.path.join(tmp_dir, "thumb")
+            uploaded_file.seek(0)
+            with Image.open(uploaded_file) as img:
+                img = ImageOps.exif_transpose(img).convert('RGB')
+                img.thumbnail(ATTACHMENT_THUMB_SIZE)
+                img.save(thumb_path, 'JPEG', quality=75)
+            store.put(thumbnail_key(key), thumb_path, 'image/jpeg')
+    return key
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def load_thumbnail(_store, key):
+    """Ambil thumbnail dari blob store (isi per key tidak pernah berubah)"""
+    return _store.get(thumbnail_key(key))
+
+@st.cache_data(ttl=ATTACHMENT_URL_EXPIRES // 2, show_spinner=False)
+def attachment_url(_store, key):
+    """Signed URL lampiran, di-cache lebih singkat dari masa berlakunya"""
+    return _store.signed_url(key)
+
+def display_attachment(label, key, store, widget_key):
+    """Tampilkan preview lampiran, file penuh baru dibuka saat diminta
+
+    Supabase Storage: file diunduh browser lewat signed URL tanpa melewati aplikasi.
+    Store lokal: st.download_button tetap membaca seluruh file ke media storage
+    Streamlit (memori sesi), jadi store lokal hanya untuk pengembangan/file kecil.
+    """
+    if not isinstance(key, str) or not key:
+        st.write(f"**{label:<18}:** -")
+        return
+    
+    st.write(f"**{label:<18}:**")
+    try:
+        if is_image_key(key):
+            try:
+                st.image(load_thumbnail(store, key))
+            except Exception:
+                st.caption("Preview tidak tersedia")
+        
+        if key not in st.session_state.opened_attachments:
+            if st.button(f"📎 Buka {label}", key=f"open_{widget_key}"):
+                st.session_state.opened_attachments.add(key)
+                st.rerun()
+            return
+        
+        # Supabase: browser mengunduh langsung dari Storage, file tidak lewat memori aplikasi
+        url = attachment_url(store, key)
+        if url:
+            st.link_button(f"⬇️ Unduh {label}", url)
+        else:
+            with store.open(key) as f:
+                st.download_button(f"⬇️ Unduh {label}", data=f,
+                                   file_name=key[:-3] if key.endswith('.gz') else key,
+                                   key=f"download_{widget_key}")
+    except Exception as e:
+        st.error(f"Error loading {label}: {e}")
 
 # ==================== FUNGSI TAMPILAN ====================
 def toggle_card_expansion(card_id):
@@ -286,6 +872,14 @@ def display_retur_card(retur, badge_class, idx):
                 st.write(f"**Status            :** {retur['Status']}")
                 st.write(f"**Diupdate Pada     :** {format_tanggal(retur['Diupdate Pada'])}")
             
+            # Lampiran hanya dimuat ketika card di-expand
+            store = get_blob_store(st.session_state.supabase)
+            col_a, col_b = st.columns(2)
+            with col_a:
+                display_attachment("Form Retur", retur.get('Form Retur'), store, f"form_{retur_id}_{idx}")
+            with col_b:
+                display_attachment("Berita Acara", retur.get('Berita Acara'), store, f"ba_{retur_id}_{idx}")
+            
             st.markdown("---")
             
             # TOMBOL AKSI - DI DALAM if is_expanded:
@@ -300,7 +894,12 @@ def display_retur_card(retur, badge_class, idx):
                             retur_df.loc[main_idx, "Status"] = "Sudah Disetujui"
                             retur_df.loc[main_idx, "Diupdate Pada"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                             
-                            if save_data_automatic(retur_df):
+                            if update_retur(retur_id, {
+                                'status': "Sudah Disetujui",
+                                'updated_at': retur_df.loc[main_idx, "Diupdate Pada"]
+                            }, "Menunggu Persetujuan"):
+                                log_status_event(retur_id, retur['Nama Barang'], "Menunggu Persetujuan",
+                                                 "Sudah Disetujui", retur_df.loc[main_idx, "Diupdate Pada"])
                                 st.success("✅ Retur disetujui dan disimpan otomatis!")
                                 time.sleep(1)
                                 st.rerun()
@@ -314,15 +913,21 @@ def display_retur_card(retur, badge_class, idx):
                         st.rerun()
                         
                 elif retur['Status'] == "Sudah Dimusnahkan":
-                    if st.button("📤 Kirim ke Pak Taufik", key=f"send_{retur_id}_{idx}", use_container_width=True):
+                    approver = branch_config()['approver']
+                    if st.button(f"📤 Kirim ke {approver}", key=f"send_{retur_id}_{idx}", use_container_width=True):
                         try:
                             retur_df = st.session_state.retur_data
                             main_idx = retur_df[retur_df['No Nota Retur'] == retur_id].index[0]
-                            retur_df.loc[main_idx, "Status"] = "Sudah Kirim ke Pak Taufik"
+                            retur_df.loc[main_idx, "Status"] = STATUS_SENT
                             retur_df.loc[main_idx, "Diupdate Pada"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                             
-                            if save_data_automatic(retur_df):
-                                st.success("✅ Retur sudah dikirim ke Pak Taufik!")
+                            if update_retur(retur_id, {
+                                'status': STATUS_SENT,
+                                'updated_at': retur_df.loc[main_idx, "Diupdate Pada"]
+                            }, "Sudah Dimusnahkan"):
+                                log_status_event(retur_id, retur['Nama Barang'], "Sudah Dimusnahkan",
+                                                 STATUS_SENT, retur_df.loc[main_idx, "Diupdate Pada"])
+                                st.success(f"✅ Retur sudah dikirim ke {approver}!")
                                 time.sleep(1)
                                 st.rerun()
                         except Exception as e:
@@ -335,6 +940,7 @@ def display_retur_card(retur, badge_class, idx):
                         if delete_retur(retur_id):
                             # Refresh data
                             st.session_state.retur_data = load_data()
+                            refresh_expiry_watchlist(get_expiry_watchlist(st.session_state.supabase, st.session_state.branch))
                             st.success("✅ Retur dihapus dan disimpan otomatis!")
                             time.sleep(1)
                             st.rerun()
@@ -344,6 +950,15 @@ def display_retur_card(retur, badge_class, idx):
             st.markdown("---")
 
 # ==================== BAGIAN UTAMA APLIKASI ====================
+# Pilih cabang sebelum data dimuat; ganti cabang hanya memuat partisi cabang tersebut
+st.sidebar.selectbox(
+    "🏢 Cabang",
+    options=list(BRANCHES),
+    format_func=lambda code: BRANCHES[code]['nama'],
+    key="branch",
+    on_change=reset_branch_session
+)
+
 # Load data jika belum diload
 if st.session_state.retur_data is None:
     st.session_state.retur_data = load_data()
@@ -361,7 +976,7 @@ with st.sidebar:
         st.success("✅ Terhubung ke Supabase")
         try:
             # Hitung total data
-            result = st.session_state.supabase.table("retur").select("id", count="exact").execute()
+            result = st.session_state.supabase.table("retur").select("id", count="exact").eq("branch", st.session_state.branch).limit(1).execute()
             st.info(f"📊 Total data: {result.count} retur")
         except:
             st.info("📊 Total data: Loading...")
@@ -377,10 +992,15 @@ with st.sidebar:
     # Tombol refresh
     if st.button("🔄 Refresh Data", use_container_width=True):
         st.session_state.retur_data = load_data()
+        if st.session_state.supabase:
+            refresh_expiry_watchlist(get_expiry_watchlist(st.session_state.supabase, st.session_state.branch))
         st.rerun()
     
     if st.button("🗑️ Clear Cache", use_container_width=True):
-        st.cache_resource.clear()
+        # Hanya cache cabang ini yang dibuang, cabang lain tidak ikut full fetch
+        if st.session_state.supabase:
+            reset_table_cache(get_table_cache(st.session_state.supabase, st.session_state.branch))
+            refresh_expiry_watchlist(get_expiry_watchlist(st.session_state.supabase, st.session_state.branch))
         st.session_state.retur_data = load_data()
         st.rerun()
     
@@ -396,7 +1016,7 @@ with st.sidebar:
         st.info("📝 Tidak ada data atau kolom Status tidak ditemukan")
 
 # ==================== HALAMAN UTAMA ====================
-st.markdown('<h1 class="main-header">📦 Pencatatan Retur PD Hero ke PT CAPP</h1>', unsafe_allow_html=True)
+st.markdown(f'<h1 class="main-header">📦 Pencatatan Retur {branch_config()["nama"]} ke {branch_config()["tujuan"]}</h1>', unsafe_allow_html=True)
 
 # Cek koneksi database
 if st.session_state.supabase is None:
@@ -424,8 +1044,7 @@ if st.session_state.show_add_form:
         col1, col2 = st.columns(2)
         
         with col1:
-            nota = generate_nota_number()
-            st.text_input("No Nota Retur*", value=nota, disabled=True)
+            st.text_input("No Nota Retur*", value="Dibuat otomatis saat diajukan", disabled=True)
             tanggal_pengajuan = st.date_input("Tanggal Pengajuan*", date.today())
             barang = st.text_input("Nama Barang*", placeholder="Masukkan nama barang")
             
@@ -454,6 +1073,8 @@ if st.session_state.show_add_form:
                 alasan = st.session_state.alasan_option
                 st.session_state.custom_reason = ""
         
+        form_retur_file = st.file_uploader("Form Retur (scan)", type=ATTACHMENT_TYPES, key="form_retur_file")
+        
         col1, col2 = st.columns(2)
         with col1:
             submitted = st.form_submit_button("📤 Ajukan Retur", use_container_width=True)
@@ -466,6 +1087,20 @@ if st.session_state.show_add_form:
             if not barang or (alasan_option == "Isi sendiri" and not st.session_state.custom_reason.strip()):
                 st.error("Harap isi semua field yang wajib (*)")
             else:
+                form_retur_key = ""
+                if form_retur_file is not None:
+                    try:
+                        form_retur_key = ingest_attachment(get_blob_store(st.session_state.supabase), form_retur_file)
+                    except Exception as e:
+                        st.error(f"Error uploading Form Retur: {e}")
+                        st.stop()
+                
+                try:
+                    nota = generate_nota_number()
+                except Exception as e:
+                    st.error(f"Error generating No Nota Retur: {e}")
+                    st.stop()
+                
                 new_data = pd.DataFrame([{
                     "No Nota Retur": nota,
                     "Tanggal Pengajuan": tanggal_pengajuan.strftime('%Y-%m-%d'),
@@ -474,22 +1109,28 @@ if st.session_state.show_add_form:
                     "Satuan": satuan,
                     "Tanggal ED": tanggal_ed.strftime('%Y-%m-%d'),
                     "Alasan": alasan,
-                    "Form Retur": "",
+                    "Form Retur": form_retur_key,
                     "Berita Acara": "",
                     "Status": "Menunggu Persetujuan",
                     "Dibuat Pada": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                     "Diupdate Pada": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 }])
 
-                # SIMPAN OTOMATIS ke Supabase
-                updated_df = pd.concat([retur_df, new_data], ignore_index=True)
-                if save_data_automatic(updated_df):
+                # SIMPAN OTOMATIS ke Supabase (insert saja)
+                if insert_retur(new_data):
+                    log_status_event(nota, barang, None, "Menunggu Persetujuan", new_data.loc[0, "Dibuat Pada"])
                     st.session_state.show_add_form = False
                     st.session_state.retur_data = load_data()  # Reload data
+                    refresh_expiry_watchlist(get_expiry_watchlist(st.session_state.supabase, st.session_state.branch))
                     st.success("✅ Retur berhasil diajukan dan disimpan di cloud!")
                     time.sleep(1)
                     st.rerun()
 
+# Watchlist Tanggal ED
+st.markdown("---")
+display_expiry_watchlist(get_expiry_watchlist(st.session_state.supabase, st.session_state.branch))
+st.markdown("---")
+
 # Tab Status Retur
 st.markdown("### 📊 Status Retur")
 
@@ -503,7 +1144,7 @@ tab1, tab2, tab3, tab4, tab5 = st.tabs([
     "Menunggu Persetujuan", 
     "Sudah Disetujui", 
     "Sudah Dimusnahkan", 
-    "Sudah Kirim ke Pak Taufik", 
+    sent_label(), 
     "Rekap Retur"  # Pastikan ada 5 tab
 ])
 
@@ -519,10 +1160,11 @@ def filter_data_by_status(df, status):
     
     return df[df["Status"] == status]
 
-# Fungsi untuk menampilkan detail pengiriman ke Pak Taufik
+# Fungsi untuk menampilkan detail pengiriman ke approver cabang
 def display_pengiriman_detail(df):
+    approver = branch_config()['approver']
     if df.empty:
-        st.info("Tidak ada data pengiriman ke Pak Taufik")
+        st.info(f"Tidak ada data pengiriman ke {approver}")
         return
     
     # Pastikan kolom tanggal pengiriman ada
@@ -540,7 +1182,7 @@ def display_pengiriman_detail(df):
         
         # Tampilkan expandable section untuk setiap tanggal
         with st.expander(f"📅 {tanggal.strftime('%d %B %Y')} - {len(group)} retur - Total: {total_quantity} unit"):
-            st.markdown(f"**Detail Pengiriman ke Pak Taufik pada {tanggal.strftime('%d %B %Y')}**")
+            st.markdown(f"**Detail Pengiriman ke {approver} pada {tanggal.strftime('%d %B %Y')}**")
             
             # Tampilkan tabel detail
             st.dataframe(
@@ -591,7 +1233,7 @@ def display_rekap_retur(df):
         
         with col4:
             destroyed = status_counts.get("Sudah Dimusnahkan", 0)
-            sent = status_counts.get("Sudah Kirim ke Pak Taufik", 0)
+            sent = status_counts.get(STATUS_SENT, 0)
             st.metric("Telah Diproses", destroyed + sent)
         
         st.markdown("---")
@@ -652,6 +1294,11 @@ def display_rekap_retur(df):
     else:
         st.warning("Kolom 'Nama Barang' tidak ditemukan untuk rekap barang")
     
+    st.markdown("---")
+    
+    # Lama waktu per status dari log event
+    display_lead_time_stats(st.session_state.supabase, st.session_state.branch)
+    
     # Chart visualisasi (jika ada data)
     if not df.empty:
         st.markdown("---")
@@ -707,13 +1354,13 @@ with tab3:
         for idx, row in filtered_df.iterrows():
             display_retur_card(row, "badge-destroyed", idx)
 
-# Tab 4: Sudah Kirim ke Pak Taufik
+# Tab 4: Sudah Kirim ke approver cabang
 with tab4:
-    filtered_df = filter_data_by_status(retur_df, "Sudah Kirim ke Pak Taufik")
+    filtered_df = filter_data_by_status(retur_df, STATUS_SENT)
     if filtered_df.empty:
-        st.info("Tidak ada retur yang sudah dikirim ke Pak Taufik")
+        st.info(f"Tidak ada retur yang sudah dikirim ke {branch_config()['approver']}")
     else:
-        st.info("📦 Berikut adalah daftar pengiriman ke Pak Taufik berdasarkan tanggal:")
+        st.info(f"📦 Berikut adalah daftar pengiriman ke {branch_config()['approver']} berdasarkan tanggal:")
         display_pengiriman_detail(filtered_df)
 
 # Tab 5: Rekap Retur - PASTIKAN TAB INI ADA DAN DITAMPILKAN
@@ -735,16 +1382,35 @@ if st.session_state.get('show_destroy_form') is not None:
     st.write(f"**Nama Barang:** {retur_data['Nama Barang']}")
     st.write(f"**Quantity:** {quantity_display}")
     
+    berita_acara_file = st.file_uploader("Berita Acara Pemusnahan (scan)", type=ATTACHMENT_TYPES, key="berita_acara_file")
+    
     col1, col2 = st.columns(2)
     with col1:
         if st.button("✅ Konfirmasi Pemusnahan", key="confirm_destroy"):
+            if berita_acara_file is not None:
+                try:
+                    retur_df.loc[idx, "Berita Acara"] = ingest_attachment(get_blob_store(st.session_state.supabase), berita_acara_file)
+                except Exception as e:
+                    st.error(f"Error uploading Berita Acara: {e}")
+                    st.stop()
+            
             # Update status di Supabase
             retur_df.loc[idx, "Status"] = "Sudah Dimusnahkan"
             retur_df.loc[idx, "Diupdate Pada"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-            if save_data_automatic(retur_df):
+            changes = {
+                'status': "Sudah Dimusnahkan",
+                'updated_at': retur_df.loc[idx, "Diupdate Pada"]
+            }
+            if berita_acara_file is not None:
+                changes['berita_acara'] = retur_df.loc[idx, "Berita Acara"]
+            
+            if update_retur(retur_data['No Nota Retur'], changes, "Sudah Disetujui"):
+                log_status_event(retur_data['No Nota Retur'], retur_data['Nama Barang'], "Sudah Disetujui",
+                                 "Sudah Dimusnahkan", retur_df.loc[idx, "Diupdate Pada"])
                 st.session_state.show_destroy_form = None
                 st.session_state.retur_data = load_data()  # Reload data
+                refresh_expiry_watchlist(get_expiry_watchlist(st.session_state.supabase, st.session_state.branch))
                 st.success("✅ Pemusnahan berhasil dikonfirmasi!")
                 time.sleep(1)
                 st.rerun()
@@ -755,4 +1421,4 @@ if st.session_state.get('show_destroy_form') is not None:
             st.rerun()
 # ==================== FOOTER ====================
 st.markdown("---")
-st.caption("© PD Hero - PT CAPP Retur Management System | Cloud Database | Owned by Yenny")
\ No newline at end of file
+st.caption(f"© {branch_config()['nama']} - {branch_config()['tujuan']} Retur Management System | Cloud Database | Owned by Yenny")
\ No newline at end of file
@@ -0,0 +1,237 @@
+-- Skema database Supabase untuk Aplikasi Pencatatan Retur PD Hero
+-- Jalankan di Supabase SQL Editor. Semua perintah aman dijalankan ulang.
+
+create table if not exists retur (
+    id bigint generated by default as identity primary key,
+    branch text not null default 'pdhero',
+    no_nota_retur text not null,
+    tanggal_pengajuan date,
+    nama_barang text,
+    quantity integer,
+    satuan text,
+    tanggal_ed date,
+    alasan text,
+    form_retur text default '',
+    berita_acara text default '',
+    status text,
+    created_at timestamp,
+    updated_at timestamp
+);
+
+-- Multi-cabang: database lama belum punya kolom branch, baris lama masuk cabang default 'pdhero'.
+-- Kode ini sama dengan LEGACY_BRANCH di app.py, yang selalu ditampilkan walaupun tidak ada di
+-- [BRANCHES.*] secrets. Jangan ganti default ini tanpa memindahkan data lama ke kode cabang lain.
+-- No Nota Retur hanya unik di dalam satu cabang (urutan nota per cabang).
+alter table retur add column if not exists branch text not null default 'pdhero';
+alter table retur drop constraint if exists retur_no_nota_retur_key;
+create unique index if not exists uq_retur_branch_nota on retur (branch, no_nota_retur);
+
+-- Sequence No Nota Retur per cabang per bulan. next_nota_number() menaikkan counter secara
+-- atomik; saat bulan baru pertama kali dipakai, counter dimulai dari nomor terbesar yang sudah ada.
+-- Hasil dikembalikan sebagai satu baris (bukan skalar) karena postgrest-py 0.10.x hanya menerima
+-- response berupa list of rows.
+create table if not exists nota_sequence (
+    branch text not null,
+    year_month text not null,
+    last_number integer not null,
+    primary key (branch, year_month)
+);
+
+drop function if exists next_nota_number(text, text);
+create or replace function next_nota_number(p_branch text, p_year_month text)
+returns table (nota_number integer)
+language plpgsql as $$
+begin
+    insert into nota_sequence as s (branch, year_month, last_number)
+    values (
+        p_branch,
+        p_year_month,
+        coalesce((
+            select max(split_part(no_nota_retur, '/', 3)::integer)
+            from retur
+            where branch = p_branch
+              and no_nota_retur ~ ('^' || p_year_month || '/[0-9]+$')
+        ), 0) + 1
+    )
+    on conflict (branch, year_month) do update
+        set last_number = s.last_number + 1
+    returning s.last_number into nota_number;
+    return next;
+end;
+$$;
+
+-- Status akhir disimpan tetap 'Sudah Dikirim'; nama approver hanya ada di label aplikasi
+update retur set status = 'Sudah Dikirim' where status like 'Sudah Kirim ke %';
+
+-- Query per cabang: filter status dan urutan waktu
+create index if not exists idx_retur_branch_status_created on retur (branch, status, created_at);
+drop index if exists idx_retur_branch_updated;
+
+-- Watchlist Tanggal ED: range query "kedaluwarsa dalam N hari" untuk retur aktif per cabang
+drop index if exists idx_retur_tanggal_ed;
+create index if not exists idx_retur_branch_tanggal_ed on retur (branch, tanggal_ed)
+    where status in ('Menunggu Persetujuan', 'Sudah Disetujui');
+
+-- Versi baris untuk delta sync snapshot cache: diisi sequence database di setiap insert/update,
+-- tidak bergantung pada updated_at yang ditulis klien.
+create sequence if not exists retur_row_version_seq;
+alter table retur add column if not exists row_version bigint not null default nextval('retur_row_version_seq');
+
+create or replace function bump_retur_row_version() returns trigger
+language plpgsql as $$
+begin
+    new.row_version := nextval('retur_row_version_seq');
+    return new;
+end;
+$$;
+
+drop trigger if exists trg_retur_row_version on retur;
+create trigger trg_retur_row_version before insert or update on retur
+    for each row execute function bump_retur_row_version();
+
+create index if not exists idx_retur_branch_row_version on retur (branch, row_version);
+
+-- Tombstone penghapusan untuk delta sync snapshot cache (diisi trigger, bukan aplikasi)
+create table if not exists retur_deleted (
+    id bigint generated by default as identity primary key,
+    branch text not null,
+    retur_id bigint not null,
+    deleted_at timestamptz not null default now()
+);
+
+create index if not exists idx_retur_deleted_branch on retur_deleted (branch, id);
+
+create or replace function record_retur_deleted() returns trigger
+language plpgsql as $$
+begin
+    insert into retur_deleted (branch, retur_id) values (old.branch, old.id);
+    return old;
+end;
+$$;
+
+drop trigger if exists trg_retur_deleted on retur;
+create trigger trg_retur_deleted after delete on retur
+    for each row execute function record_retur_deleted();
+
+-- Bucket lampiran Form Retur / Berita Acara (ATTACHMENT_BUCKET di secrets, default retur-lampiran).
+-- Privat: file dibuka lewat signed URL yang dibuat aplikasi.
+insert into storage.buckets (id, name, public)
+values ('retur-lampiran', 'retur-lampiran', false)
+on conflict (id) do nothing;
+
+drop policy if exists "retur_lampiran_akses" on storage.objects;
+create policy "retur_lampiran_akses" on storage.objects
+    for all to anon, authenticated
+    using (bucket_id = 'retur-lampiran')
+    with check (bucket_id = 'retur-lampiran');
+
+-- Log perpindahan status (append-only) untuk analitik lama waktu per status
+create table if not exists retur_events (
+    id bigint generated by default as identity primary key,
+    branch text not null default 'pdhero',
+    no_nota_retur text not null,
+    nama_barang text,
+    from_status text,
+    to_status text not null,
+    event_at timestamp not null default now()
+);
+
+alter table retur_events add column if not exists branch text not null default 'pdhero';
+
+-- Status akhir di log event juga memakai nilai tetap
+update retur_events set to_status = 'Sudah Dikirim' where to_status like 'Sudah Kirim ke %';
+update retur_events set from_status = 'Sudah Dikirim' where from_status like 'Sudah Kirim ke %';
+
+drop index if exists idx_retur_events_nota;
+drop index if exists idx_retur_events_branch;
+create index if not exists idx_retur_events_branch_nota on retur_events (branch, no_nota_retur, id);
+
+-- Agregat lama waktu per status (materialized), diperbarui trigger setiap event baru.
+-- dimension = 'week' (minggu ISO saat status ditinggalkan) atau 'product' (nama barang).
+create table if not exists retur_lead_time_stats (
+    id bigint generated by default as identity primary key,
+    branch text not null,
+    dimension text not null,
+    stage text not null,
+    group_key text not null,
+    event_count integer not null default 0,
+    total_days double precision not null default 0,
+    buckets integer[] not null,
+    unique (branch, dimension, stage, group_key)
+);
+
+-- Batas atas bucket histogram (hari); harus sama dengan LEAD_TIME_BUCKETS di app.py.
+-- Bucket ke-15 menampung durasi di atas 180 hari.
+create or replace function lead_time_bucket(days double precision) returns integer
+language sql immutable as $$
+    select coalesce(min(i), 15)::integer
+    from unnest(array[0.5, 1, 2, 3, 5, 7, 10, 14, 21, 30, 45, 60, 90, 180]::double precision[])
+        with ordinality as b(bound, i)
+    where days <= bound;
+$$;
+
+create or replace function add_lead_time(p_branch text, p_dimension text, p_stage text,
+                                         p_group_key text, p_days double precision)
+returns void language plpgsql as $$
+declare
+    v_bucket integer := lead_time_bucket(p_days);
+    v_buckets integer[] := array_fill(0, array[15]);
+begin
+    v_buckets[v_bucket] := 1;
+    insert into retur_lead_time_stats as s (branch, dimension, stage, group_key, event_count, total_days, buckets)
+    values (p_branch, p_dimension, p_stage, p_group_key, 1, p_days, v_buckets)
+    on conflict (branch, dimension, stage, group_key) do update
+        set event_count = s.event_count + 1,
+            total_days = s.total_days + excluded.total_days,
+            buckets[v_bucket] = s.buckets[v_bucket] + 1;
+end;
+$$;
+
+-- Lama waktu status sebelumnya = event ini - event terakhir untuk nota yang sama
+create or replace function apply_retur_event() returns trigger
+language plpgsql as $$
+declare
+    prev record;
+    v_days double precision;
+begin
+    select to_status, event_at into prev
+    from retur_events
+    where branch = new.branch and no_nota_retur = new.no_nota_retur and id < new.id
+    order by id desc
+    limit 1;
+    
+    if found then
+        v_days := extract(epoch from new.event_at - prev.event_at) / 86400;
+        if v_days >= 0 then
+            perform add_lead_time(new.branch, 'week', prev.to_status, to_char(new.event_at, 'IYYY-"W"IW'), v_days);
+            perform add_lead_time(new.branch, 'product', prev.to_status, coalesce(new.nama_barang, '-'), v_days);
+        end if;
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists trg_retur_events_lead_time on retur_events;
+create trigger trg_retur_events_lead_time after insert on retur_events
+    for each row execute function apply_retur_event();
+
+-- Isi awal agregat dari event yang tercatat sebelum trigger dipasang (hanya jika masih kosong)
+do $$
+begin
+    if not exists (select 1 from retur_lead_time_stats) then
+        perform add_lead_time(e.branch, d.dimension, e.stage, d.group_key, e.days)
+        from (
+            select branch, nama_barang, event_at,
+                   lag(to_status) over w as stage,
+                   extract(epoch from event_at - lag(event_at) over w) / 86400 as days
+            from retur_events
+            window w as (partition by branch, no_nota_retur order by id)
+        ) e
+        cross join lateral (values
+            ('week', to_char(e.event_at, 'IYYY-"W"IW')),
+            ('product', coalesce(e.nama_barang, '-'))
+        ) as d(dimension, group_key)
+        where e.stage is not null and e.days >= 0;
+    end if;
+end;
+$$;